@@ -1,30 +1,60 @@
 import asyncio
+import base64
+import hashlib
 import logging
-from typing import List, Dict, Optional
-from azure.storage.blob import BlobServiceClient, ContainerClient
-from azure.core.exceptions import AzureError
+from typing import AsyncIterable, AsyncIterator, Callable, IO, List, Dict, Optional, Set, Union
+from azure.storage.blob import BlobBlock, ContentSettings
+from azure.storage.blob.aio import BlobServiceClient, ContainerClient
+from azure.core.exceptions import ResourceExistsError, ResourceNotFoundError
 import io
 
 logger = logging.getLogger(__name__)
 
+# 分块上传时每个块的大小，超过该大小的数据流会拆分为多个块并行上传
+BLOCK_SIZE = 8 * 1024 * 1024
+# 单次 Put Blob 上传的最大大小（与SDK默认值一致），不超过该大小的文件一次请求上传，服务端自动计算Content-MD5
+MAX_SINGLE_PUT_SIZE = 64 * 1024 * 1024
+
+async def _hash_chunks(chunks: AsyncIterable[bytes], digest) -> AsyncIterator[bytes]:
+    # 在数据块流经时计算哈希，无需再次读取文件内容
+    async for chunk in chunks:
+        digest.update(chunk)
+        yield chunk
+
+async def _read_blocks(chunks: AsyncIterable[bytes], block_size: int) -> AsyncIterator[bytes]:
+    # 将任意大小的数据块流重新切分为固定大小的块，最后一块可能较小
+    buffer = bytearray()
+    async for chunk in chunks:
+        buffer.extend(chunk)
+        while len(buffer) >= block_size:
+            yield bytes(buffer[:block_size])
+            del buffer[:block_size]
+    if buffer:
+        yield bytes(buffer)
+
 class BlobUploadService:
     # Azure Blob Storage上传服务类
     # 负责处理文件上传和列表操作
     
-    def __init__(self, connection_string: str):
+    def __init__(self, connection_string: str, max_concurrency: int = 4):
         # 初始化Blob上传服务
         # connection_string: Azure Storage连接字符串，包含账户信息和访问密钥
+        # max_concurrency: 单个大文件分块上传时的并行请求数
         self.connection_string = connection_string
+        self.max_concurrency = max_concurrency
         self.blob_service_client = None  # Blob服务客户端实例
+        self._known_containers: Set[str] = set()  # 已确认存在的容器，避免每次上传都重复检查
+        self._container_lock = asyncio.Lock()  # 防止并发上传时重复检查/创建同一个容器
         self._initialize_client()  # 初始化客户端连接
     
     def _initialize_client(self):
         # 初始化Blob服务客户端
         # 使用连接字符串创建Azure Blob Storage客户端
         try:
-            # 从连接字符串创建BlobServiceClient实例
+            # 从连接字符串创建BlobServiceClient实例（原生异步SDK，所有操作都是协程，不占用线程池）
             self.blob_service_client = BlobServiceClient.from_connection_string(
-                self.connection_string
+                self.connection_string,
+                max_single_put_size=MAX_SINGLE_PUT_SIZE
             )
             logger.info("Azure Blob Storage client initialized successfully")
         except Exception as e:
@@ -33,74 +63,141 @@ class BlobUploadService:
     
     async def _ensure_container_exists(self, container_client: ContainerClient):
         # 确保容器存在，如果不存在则自动创建
+        # 直接尝试创建容器并忽略409，一次请求代替"查询属性+创建"两次请求
+        # 每个容器只处理一次，结果缓存在 _known_containers 中
         # container_client: 容器客户端对象
-        try:
-            # 尝试获取容器属性，如果容器不存在会抛出404错误
-            await asyncio.to_thread(container_client.get_container_properties)
-        except AzureError as e:
-            if e.status_code == 404:  # 容器不存在
-                logger.info(f"Container {container_client.container_name} does not exist, creating...")
-                # 创建新容器
-                await asyncio.to_thread(container_client.create_container)
-                logger.info(f"Container {container_client.container_name} created successfully")
-            else:
-                # 其他错误则重新抛出
-                raise
+        container_name = container_client.container_name
+        if container_name in self._known_containers:
+            return
+        
+        async with self._container_lock:
+            # 等待锁期间其他上传可能已经完成了检查
+            if container_name in self._known_containers:
+                return
+            try:
+                await container_client.create_container()
+                logger.info(f"Container {container_name} created successfully")
+            except ResourceExistsError:
+                # 409：容器已存在
+                pass
+            self._known_containers.add(container_name)
     
-    def list_blobs(self, container_name: str) -> List[str]:
+    async def list_blobs(self, container_name: str, name_starts_with: Optional[str] = None) -> List[str]:
         # 列出容器中的所有Blob文件
         # container_name: 容器名称
+        # name_starts_with: 只列出以此前缀开头的Blob，由服务端过滤
         # 返回值: Blob文件名称列表
         try:
             # 获取容器客户端
             container_client = self.blob_service_client.get_container_client(container_name)
-            # 列出容器中的所有Blob
-            blobs = container_client.list_blobs()
-            # 提取所有Blob的名称
-            blob_names = [blob.name for blob in blobs]
+            # 只请求名称（不返回属性），每页最多5000项；异步遍历分页结果，不会阻塞事件循环
+            names = container_client.list_blob_names(name_starts_with=name_starts_with, results_per_page=5000)
+            blob_names = [name async for name in names]
             logger.info(f"Found {len(blob_names)} blobs in container {container_name}")
             return blob_names
         except Exception as e:
             logger.error(f"Failed to list blobs in container {container_name}: {e}")
             return []
     
-    def test_connection(self) -> bool:
+    async def list_blob_metadata(self, container_name: str, name_starts_with: Optional[str] = None) -> Dict[str, Dict[str, str]]:
+        # 列出容器中的Blob及其元数据，元数据随列表一起返回，无需逐个查询属性
+        # container_name: 容器名称
+        # name_starts_with: 只列出以此前缀开头的Blob
+        # 返回值: Blob名称到元数据字典的映射
+        try:
+            container_client = self.blob_service_client.get_container_client(container_name)
+            blobs = container_client.list_blobs(
+                name_starts_with=name_starts_with, include=['metadata'], results_per_page=5000
+            )
+            blob_metadata = {blob.name: blob.metadata or {} async for blob in blobs}
+            logger.info(f"Found {len(blob_metadata)} blobs in container {container_name}")
+            return blob_metadata
+        except ResourceNotFoundError:
+            # 容器尚不存在，视为没有Blob
+            return {}
+        except Exception as e:
+            logger.error(f"Failed to list blobs in container {container_name}: {e}")
+            return {}
+    
+    async def test_connection(self) -> bool:
         # 测试Azure Blob Storage连接
         try:
             # 尝试列出账户中的所有容器
             # 这是一个轻量级的API调用，用于验证连接是否正常
             containers = self.blob_service_client.list_containers()
-            # 转换为列表以触发实际的API调用
-            list(containers)
+            # 遍历分页结果以触发实际的API调用
+            async for _ in containers:
+                pass
             logger.info("Azure Blob Storage connection test successful")
             return True
         except Exception as e:
             logger.error(f"Azure Blob Storage connection test failed: {e}")
             return False
     
+    async def _upload_blob(self, blob_client, data, length: Optional[int], metadata: Dict[str, str]):
+        # 上传文件，文件内容和元数据在同一次请求中写入
+        # metadata参数可以包含文件的描述、标签等信息，无需再单独调用 set_blob_metadata
+        # 超过单次上传大小的文件由SDK分块，max_concurrency 个块并行上传
+        await blob_client.upload_blob(
+            data,
+            length=length,
+            overwrite=True,
+            metadata=metadata,
+            max_concurrency=self.max_concurrency
+        )
+    
     async def upload_with_metadata(self, container_name: str, blob_name: str, 
-                                 file_data: bytes, metadata: Dict[str, str]) -> bool:
+                                 file_data: Union[bytes, IO, AsyncIterable[bytes]],
+                                 metadata: Dict[str, str], length: Optional[int] = None,
+                                 compute_md5: bool = False) -> bool:
         # 上传文件并设置元数据
         # container_name: 容器名称
         # blob_name: Blob名称
-        # file_data: 文件数据（字节格式）
+        # file_data: 文件数据，可以是字节、文件对象或异步数据块流（流式上传，不在内存中缓存整个文件）
         # metadata: 元数据字典，可以包含文件的额外信息
+        # length: 数据长度（字节），流式上传时提供可让SDK按块上传
+        # compute_md5: 是否为数据流写入Content-MD5属性；长度已知且不超过单次上传大小时由服务端自动计算，无需处理
         try:
-            # 获取容器客户端并确保容器存在
             container_client = self.blob_service_client.get_container_client(container_name)
-            await self._ensure_container_exists(container_client)
-            
-            # 获取Blob客户端
             blob_client = container_client.get_blob_client(blob_name)
             
-            # 使用异步线程池上传文件并设置元数据
-            # metadata参数可以包含文件的描述、标签等信息
-            await asyncio.to_thread(
-                blob_client.upload_blob,
-                file_data,
-                overwrite=True,
-                metadata=metadata
-            )
+            # 字节数据可以在失败后重新上传，因此直接乐观上传，仅在容器不存在时才创建
+            # 数据流读取后无法重放，上传前需要先确保容器存在
+            replayable = isinstance(file_data, (bytes, bytearray))
+            if not replayable:
+                await self._ensure_container_exists(container_client)
+            
+            block_upload = (isinstance(file_data, AsyncIterable) and length is not None
+                            and length > MAX_SINGLE_PUT_SIZE)
+            # 只有分块上传（长度未知或超过单次上传大小）时服务端不会计算MD5，需要在数据流经时自行计算
+            digest = None
+            if compute_md5 and isinstance(file_data, AsyncIterable) and (length is None or block_upload):
+                digest = hashlib.md5()
+                file_data = _hash_chunks(file_data, digest)
+            try:
+                if block_upload:
+                    # 大文件数据流：块并行上传，MD5随块列表一起提交
+                    await self._stage_and_commit(blob_client, file_data, metadata,
+                                                 content_md5=digest.digest if digest is not None else None)
+                else:
+                    await self._upload_blob(blob_client, file_data, length, metadata)
+            except ResourceNotFoundError as e:
+                if e.error_code != 'ContainerNotFound':
+                    raise
+                # 容器不存在（或已被删除）：清除缓存，使下一次上传重新创建容器
+                self._known_containers.discard(container_name)
+                # 数据流已经读取，无法重放，本次上传失败
+                if not replayable:
+                    raise
+                # 字节数据：创建容器后重试一次
+                await self._ensure_container_exists(container_client)
+                await self._upload_blob(blob_client, file_data, length, metadata)
+            self._known_containers.add(container_name)
+            
+            # 长度未知的数据流由SDK分块上传，MD5在上传完成后才能得到，需要单独写入
+            # 写入失败只记录日志，不影响上传结果（文件内容和元数据已经写入）
+            if digest is not None and not block_upload:
+                await self.set_content_md5(container_name, blob_name, digest.digest())
             
             logger.info(f"File uploaded successfully to blob: {blob_name}")
             return True
@@ -109,19 +206,98 @@ class BlobUploadService:
             logger.error(f"Failed to upload file to blob {blob_name}: {e}")
             return False
     
-    async def list_blob_files(self, container_name: str) -> List[str]:
-        # 列出指定容器中的所有Blob文件（异步版本）
+    async def upload_large(self, container_name: str, blob_name: str, stream: AsyncIterable[bytes],
+                           metadata: Dict[str, str], block_size: int = BLOCK_SIZE,
+                           max_concurrency: Optional[int] = None) -> bool:
+        # 以块并行的方式上传大文件：按 block_size 切分数据流，多个块同时 stage_block，最后一次 commit_block_list
+        # 内存中最多保留 max_concurrency 个正在上传的块
         # container_name: 容器名称
-        # 返回值: Blob文件名称列表
+        # blob_name: Blob名称
+        # stream: 异步数据块流
+        # metadata: 元数据字典，在提交块列表时一并写入
+        # max_concurrency: 同时上传的块数，默认使用服务的 max_concurrency
         try:
-            # 获取容器客户端
             container_client = self.blob_service_client.get_container_client(container_name)
-            # 使用异步线程池列出Blob
-            blobs = await asyncio.to_thread(container_client.list_blobs)
-            # 提取所有Blob的名称
-            blob_names = [blob.name for blob in blobs]
-            logger.info(f"Found {len(blob_names)} blobs in container {container_name}")
-            return blob_names
+            await self._ensure_container_exists(container_client)
+            blob_client = container_client.get_blob_client(blob_name)
+            await self._stage_and_commit(blob_client, stream, metadata, block_size, max_concurrency)
+            logger.info(f"File uploaded successfully to blob: {blob_name}")
+            return True
         except Exception as e:
-            logger.error(f"Failed to list blobs in container {container_name}: {e}")
-            return []
\ No newline at end of file
+            logger.error(f"Failed to upload file to blob {blob_name}: {e}")
+            return False
+    
+    async def _stage_and_commit(self, blob_client, stream: AsyncIterable[bytes], metadata: Dict[str, str],
+                                block_size: int = BLOCK_SIZE, max_concurrency: Optional[int] = None,
+                                content_md5: Optional[Callable[[], bytes]] = None):
+        # 读取数据流并并行上传各个块，全部成功后提交块列表
+        sem = asyncio.Semaphore(max_concurrency or self.max_concurrency)
+        block_ids = []
+        tasks = []
+        errors: List[BaseException] = []  # 已失败的块上传，出现后立即停止读取数据流
+        
+        async def stage(block_id: str, data: bytes):
+            try:
+                await blob_client.stage_block(block_id, data)
+            except Exception as e:
+                errors.append(e)
+                raise
+            finally:
+                sem.release()
+        
+        try:
+            index = 0
+            async for block in _read_blocks(stream, block_size):
+                # 等待空闲的上传槽位后再读取下一块，限制内存占用
+                await sem.acquire()
+                # 已有块上传失败（如403、认证失败）时不再继续下载和上传剩余数据
+                if errors:
+                    sem.release()
+                    raise errors[0]
+                # 同一个Blob的所有块ID长度必须相同
+                block_id = base64.b64encode(f"{index:08d}".encode()).decode()
+                block_ids.append(block_id)
+                tasks.append(asyncio.create_task(stage(block_id, block)))
+                index += 1
+            await asyncio.gather(*tasks)
+        except BaseException:
+            for task in tasks:
+                task.cancel()
+            # 等待所有块上传真正结束后再抛出异常，同时取出失败任务的异常
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+        
+        # 提交块列表，同时写入元数据；此时数据流已读完，MD5可以一并写入，不需要额外请求
+        content_settings = None
+        if content_md5 is not None:
+            content_settings = ContentSettings(content_type='application/octet-stream',
+                                               content_md5=bytearray(content_md5()))
+        await blob_client.commit_block_list([BlobBlock(block_id=block_id) for block_id in block_ids],
+                                            metadata=metadata, content_settings=content_settings)
+    
+    async def set_content_md5(self, container_name: str, blob_name: str, content_md5: bytes) -> bool:
+        # 设置Blob的Content-MD5属性，用于下载时的完整性校验
+        # 长度未知的数据流在上传完成后才能得到MD5，因此需要单独一次请求写入
+        try:
+            blob_client = self.blob_service_client.get_blob_client(container_name, blob_name)
+            # set_http_headers 会覆盖全部内容属性，这里保留上传时的默认Content-Type
+            await blob_client.set_http_headers(content_settings=ContentSettings(
+                content_type='application/octet-stream',
+                content_md5=bytearray(content_md5)
+            ))
+            return True
+        except Exception as e:
+            logger.error(f"Failed to set Content-MD5 for blob {blob_name}: {e}")
+            return False
+    
+    async def list_blob_files(self, container_name: str, name_starts_with: Optional[str] = None) -> List[str]:
+        # 列出指定容器中的所有Blob文件（与 list_blobs 相同，保留以兼容现有调用方）
+        # container_name: 容器名称
+        # name_starts_with: 只列出以此前缀开头的Blob
+        # 返回值: Blob文件名称列表
+        return await self.list_blobs(container_name, name_starts_with=name_starts_with)
+    
+    async def aclose(self):
+        # 关闭Blob服务客户端，释放底层HTTP连接
+        if self.blob_service_client is not None:
+            await self.blob_service_client.close()
\ No newline at end of file
@@ -1,25 +1,93 @@
-import aiohttp
-from typing import List, Dict, Optional
+import asyncio
+import time
+import httpx
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List, Dict, Optional, Tuple
 import logging
+from urllib.parse import urlparse
+
+from .throttling import (AIMDController, RETRYABLE_STATUS_CODES, THROTTLE_STATUS_CODES, create_rate_limiter,
+                         parse_retry_after, retry_with_backoff)
 
 logger = logging.getLogger(__name__)
 
 class SharePointGraphAPI:
     # SharePoint Graph API 客户端
-    def __init__(self, tenant_id: str, client_id: str, client_secret: str, site_url: str):
+    def __init__(self, tenant_id: str, client_id: str, client_secret: str, site_url: str,
+                 controller: Optional[AIMDController] = None):
         # 这些参数都是从Supabase获取的，不是预定义的
         self.site_url = site_url  # 从Supabase获取的SharePoint站点URL
         self.tenant_id = tenant_id # Azure AD 租户 ID
         self.client_id = client_id # Azure AD 应用程序客户端 ID
         self.client_secret = client_secret # Azure AD 应用程序客户端密钥
         self.access_token = None # 访问令牌
+        self._token_expiry = 0.0 # 令牌过期时间（time.monotonic() 时间戳）
+        self._token_lock = asyncio.Lock() # 防止并发请求同时刷新令牌
+        # 认证请求头只在令牌刷新时构建一次，每次请求直接复用
+        self._headers: Dict[str, str] = {} # JSON 请求使用的请求头
+        self._download_headers: Dict[str, str] = {} # 下载等不带请求体的请求使用的请求头
+        self._stream_headers: Dict[str, str] = {} # 流式下载文件内容使用的请求头，要求不压缩以保证 Content-Length 与实际字节数一致
         self.base_url = "https://graph.microsoft.com/v1.0" # SharePoint Graph API 基础 URL
+        # 列出文件时只请求需要的字段，每页最多返回999项
+        self.list_query = "$select=id,name,size,lastModifiedDateTime,webUrl,file&$top=999"
+        self.batch_size = 20 # Graph $batch 每次最多合并20个请求
+        self.batch_concurrency = 4 # 同时发送的 $batch 请求数，避免大量文件时一次性占满配额
+        self.batch_max_retries = 3 # $batch 中被限流或5xx的子请求最多重新发送的次数
+        # 站点URL只在初始化时解析一次，真实的site ID（GUID）在首次请求时解析并缓存
+        self._hostname, self._site_name = self._parse_site_url()
+        self._site_id_cache: Optional[str] = None
+        self._site_id_lock = asyncio.Lock()
+        self._client: Optional[httpx.AsyncClient] = None # 共享的HTTP/2客户端，多个请求复用同一个连接
+        self.controller = controller # AIMD并发控制器，由调用方传入，根据限流响应调整并发上限
+        self._rate_limiter = create_rate_limiter() # 按Graph配额主动限速（需安装aiolimiter）
         
         logger.info(f"SharePoint Graph API client initialized for site: {site_url}")
     
-    async def get_access_token(self) -> Optional[str]:
-        # 从 Azure AD 获取访问令牌
-        try:
+    async def _get_client(self) -> httpx.AsyncClient:
+        # 懒加载共享的HTTP/2客户端，并发请求在同一个TLS连接上多路复用，避免每次调用都重新建立TCP+TLS连接
+        # 下载接口会302重定向到预签名地址，因此需要跟随重定向（跨域时httpx会自动去掉Authorization头）
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=64, max_keepalive_connections=32, keepalive_expiry=60),
+                timeout=httpx.Timeout(300.0),
+                follow_redirects=True
+            )
+        return self._client
+    
+    async def close(self):
+        # 关闭共享客户端，释放连接池
+        if self._client is not None and not self._client.is_closed:
+            await self._client.aclose()
+        self._client = None
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+    
+    @retry_with_backoff(max_retries=3)
+    async def _request(self, method: str, url: str, stream: bool = False, **kwargs) -> httpx.Response:
+        # 发送 Graph API 请求并返回响应对象
+        # stream=True 时不读取响应体，调用方负责通过 response.aclose() 释放连接
+        # 非2xx响应抛出 httpx.HTTPStatusError，429/5xx 和网络错误由 retry_with_backoff 负责等待和重试
+        if self._rate_limiter is not None:
+            await self._rate_limiter.acquire()
+        client = await self._get_client()
+        response = await client.send(client.build_request(method, url, **kwargs), stream=stream)
+        if response.is_error:
+            await response.aclose()
+            response.raise_for_status()
+        return response
+    
+    async def get_access_token(self) -> str:
+        # 从 Azure AD 获取访问令牌，失败时抛出 httpx.HTTPError
+        # 令牌在过期前60秒内才会刷新，并发调用只会触发一次令牌请求
+        async with self._token_lock:
+            if self.access_token and time.monotonic() < self._token_expiry - 60:
+                return self.access_token
+            
             token_url = f"https://login.microsoftonline.com/{self.tenant_id}/oauth2/v2.0/token"
             
             data = {
@@ -29,136 +97,226 @@ class SharePointGraphAPI:
                 'scope': 'https://graph.microsoft.com/.default'
             }
             
-            async with aiohttp.ClientSession() as session:
-                async with session.post(token_url, data=data) as response:
-                    if response.status == 200: #如果返回 200 OK，解析 JSON 响应
-                        token_data = await response.json()
-                        self.access_token = token_data.get('access_token')
-                        logger.info("Access token obtained successfully")
-                        return self.access_token
-                    else:
-                        logger.error(f"Failed to get access token: {response.status}")
-                        return None
-                        
-        except Exception as e:
-            logger.error(f"Error getting access token: {e}")
-            return None
+            response = await self._request('POST', token_url, data=data)
+            token_data = response.json()
+            self.access_token = token_data['access_token']
+            self._token_expiry = time.monotonic() + float(token_data.get('expires_in', 3600))
+            self._download_headers = {'Authorization': f'Bearer {self.access_token}'}
+            self._headers = {**self._download_headers, 'Content-Type': 'application/json'}
+            self._stream_headers = {**self._download_headers, 'Accept-Encoding': 'identity'}
+            logger.info("Access token obtained successfully")
+            return self.access_token
     
     async def list_files(self, folder_path: str = "/") -> List[Dict]:
         # 调用 Microsoft Graph API 来列出指定 SharePoint 文件夹中的文件
+        # 会跟随 @odata.nextLink 读取所有分页，不会截断大文件夹
         try:
-            if not self.access_token:
-                await self.get_access_token()
-            
-            if not self.access_token:
-                logger.error("No access token available")
-                return []
-            
-            # 从site URL中提取site ID
-            site_id = self._extract_site_id_from_url()
-            if not site_id:
-                logger.error("Could not extract site ID from URL")
-                return []
-            
-            # 构建API请求URL
-            if folder_path == "/":
-            # 根目录
-                url = f"{self.base_url}/sites/{site_id}/drive/root/children"
-            else:
-            # 子目录
-                url = f"{self.base_url}/sites/{site_id}/drive/root:/{folder_path}:/children"
-            
-            # 设置HTTP请求头
-            headers = {
-                'Authorization': f'Bearer {self.access_token}',
-                'Content-Type': 'application/json'
-            }
-            
-            # async with：确保请求完成后自动关闭连接，避免资源泄露。
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 200:
-                        data = await response.json()
-                        files = []
-                        for item in data.get('value', []):
-                            if item.get('file'):  # 只返回文件，不返回文件夹
-                                files.append({
-                                    'id': item['id'],
-                                    'name': item['name'],
-                                    'size': item.get('size', 0),
-                                    'last_modified': item.get('lastModifiedDateTime'),
-                                    'web_url': item.get('webUrl')
-                                })
-                        logger.info(f"Found {len(files)} files in SharePoint")
-                        return files
-                    else:
-                        logger.error(f"Failed to list files: {response.status}")
-                        return []
-                        
-        except Exception as e:
+            files = []
+            async for page in self.iter_files(folder_path):
+                files.extend(page)
+            logger.info(f"Found {len(files)} files in SharePoint")
+            return files
+        except (httpx.HTTPError, ValueError) as e:
             logger.error(f"Error listing files: {e}")
             return []
     
+    async def iter_files(self, folder_path: str = "/") -> AsyncIterator[List[Dict]]:
+        # 按页异步返回指定 SharePoint 文件夹中的文件
+        # 处理当前页时已在后台预取下一页，调用方可以边列举边处理
+        # 请求失败时抛出 httpx.HTTPError
+        # 获取site ID
+        site_id = await self._resolve_site_id()
+        
+        # 构建API请求URL
+        if folder_path == "/":
+        # 根目录
+            url = f"{self.base_url}/sites/{site_id}/drive/root/children?{self.list_query}"
+        else:
+        # 子目录
+            url = f"{self.base_url}/sites/{site_id}/drive/root:/{folder_path}:/children?{self.list_query}"
+        
+        next_page = asyncio.ensure_future(self._fetch_page(url))
+        try:
+            while next_page is not None:
+                data = await next_page
+                next_url = data.get('@odata.nextLink')
+                next_page = asyncio.ensure_future(self._fetch_page(next_url)) if next_url else None
+                
+                files = []
+                for item in data.get('value', []):
+                    if item.get('file'):  # 只返回文件，不返回文件夹
+                        files.append({
+                            'id': item['id'],
+                            'name': item['name'],
+                            'size': item.get('size', 0),
+                            'last_modified': item.get('lastModifiedDateTime'),
+                            'web_url': item.get('webUrl')
+                        })
+                yield files
+        finally:
+            # 调用方提前结束遍历时取消尚未完成的预取
+            if next_page is not None and not next_page.done():
+                next_page.cancel()
+    
+    async def _fetch_page(self, url: str) -> Dict[str, Any]:
+        # 获取一页文件列表，请求失败时抛出 httpx.HTTPError
+        await self.get_access_token()
+        response = await self._request('GET', url, headers=self._headers)
+        return response.json()
+    
+    async def batch_get(self, urls: List[str]) -> List[Dict]:
+        # 通过 Graph $batch 接口合并多个GET请求，每20个请求只需一次HTTPS往返
+        # urls: 相对于 base_url 的请求路径，例如 /sites/{site_id}/drive/items/{id}
+        # 返回值: 与 urls 顺序一致的响应列表，每项包含 status、headers、body
+        # 注意：文件内容（/content）不能通过 $batch 下载
+        # Graph 对 $batch 中的每个子请求单独限流：外层返回200，子响应可能是429/5xx并带有自己的 Retry-After
+        # 这些子请求按其中最大的 Retry-After（缺省为指数退避）等待后重新发送，同时通知AIMD控制器降低并发
+        await self.get_access_token()
+        headers = self._headers
+        sem = asyncio.Semaphore(self.batch_concurrency)
+        
+        async def send_batch(start: int) -> List[Dict]:
+            chunk = urls[start:start + self.batch_size]
+            results: List[Dict] = [{"status": None}] * len(chunk)
+            pending = list(range(len(chunk)))
+            attempt = 0
+            while True:
+                payload = {
+                    "requests": [
+                        {"id": str(i), "method": "GET", "url": chunk[i]}
+                        for i in pending
+                    ]
+                }
+                async with sem:
+                    response = await self._request('POST', f"{self.base_url}/$batch", headers=headers, json=payload)
+                data = response.json()
+                # $batch 不保证响应顺序，按请求id还原
+                responses = {item['id']: item for item in data.get('responses', [])}
+                retry = []
+                throttled = False
+                delay: Optional[float] = None
+                for i in pending:
+                    item = responses.get(str(i), {"status": None})
+                    results[i] = item
+                    status = item.get('status')
+                    if status not in RETRYABLE_STATUS_CODES:
+                        continue
+                    retry.append(i)
+                    throttled = throttled or status in THROTTLE_STATUS_CODES
+                    item_headers = {k.lower(): v for k, v in (item.get('headers') or {}).items()}
+                    retry_after = parse_retry_after(item_headers.get('retry-after'))
+                    if retry_after is not None:
+                        delay = max(delay or 0.0, retry_after)
+                if throttled and self.controller is not None:
+                    self.controller.on_throttle()
+                if not retry or attempt >= self.batch_max_retries:
+                    return results
+                delay = delay if delay is not None else 2 ** attempt
+                attempt += 1
+                logger.warning(f"{len(retry)} batch requests throttled or failed, retrying in {delay}s "
+                               f"(attempt {attempt}/{self.batch_max_retries})")
+                await asyncio.sleep(delay)
+                pending = retry
+        
+        batches = await asyncio.gather(*(send_batch(start) for start in range(0, len(urls), self.batch_size)))
+        return [item for batch in batches for item in batch]
+    
+    async def get_files_metadata(self, file_ids: List[str]) -> List[Optional[Dict]]:
+        # 批量获取文件元数据，获取失败的文件返回 None
+        try:
+            site_id = await self._resolve_site_id()
+            urls = [
+                f"/sites/{site_id}/drive/items/{file_id}?$select=id,name,size,lastModifiedDateTime,webUrl,file"
+                for file_id in file_ids
+            ]
+            results = []
+            for file_id, response in zip(file_ids, await self.batch_get(urls)):
+                if response.get('status') == 200:
+                    results.append(response.get('body'))
+                else:
+                    logger.error(f"Failed to get metadata for file {file_id}: {response.get('status')}")
+                    results.append(None)
+            return results
+        except (httpx.HTTPError, ValueError) as e:
+            logger.error(f"Error getting file metadata: {e}")
+            return [None] * len(file_ids)
+    
+    async def _build_download_url(self, file_id: str) -> str:
+        # 构建文件内容的下载URL
+        site_id = await self._resolve_site_id()
+        return f"{self.base_url}/sites/{site_id}/drive/items/{file_id}/content"
+    
     async def download_file(self, file_id: str) -> Optional[bytes]:
-        # 从 SharePoint 下载文件
+        # 从 SharePoint 下载文件（整个文件读入内存）
         try:
-            if not self.access_token:
-                await self.get_access_token()
-            
-            if not self.access_token:
-                logger.error("No access token available")
-                return None
-            
-            # 构建下载URL
-            # 从site URL中提取site ID
-            site_id = self._extract_site_id_from_url()
-            if not site_id:
-                logger.error("Could not extract site ID from URL")
-                return None
-            
-            url = f"{self.base_url}/sites/{site_id}/drive/items/{file_id}/content"
-            
-            # 设置HTTP请求头
-            headers = {
-                'Authorization': f'Bearer {self.access_token}'
-            }
+            # 确保访问令牌有效，请求头随令牌刷新
+            await self.get_access_token()
+            url = await self._build_download_url(file_id)
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers) as response:
-                    if response.status == 200:
-                        file_data = await response.read()
-                        logger.info(f"File downloaded successfully, size: {len(file_data)} bytes")
-                        return file_data
-                    else:
-                        logger.error(f"Failed to download file: {response.status}")
-                        return None
+            response = await self._request('GET', url, headers=self._download_headers)
+            file_data = response.content
+            logger.info(f"File downloaded successfully, size: {len(file_data)} bytes")
+            return file_data
                         
-        except Exception as e:
+        except (httpx.HTTPError, ValueError) as e:
             logger.error(f"Error downloading file: {e}")
             return None
     
-    def _extract_site_id_from_url(self) -> Optional[str]:
-        # 从 SharePoint 站点 URL 中提取站点 ID
+    @asynccontextmanager
+    async def download_file_stream(self, file_id: str) -> AsyncIterator[httpx.Response]:
+        # 以流式方式从 SharePoint 下载文件
+        # 返回打开的响应对象，调用方通过 response.aiter_bytes() 分块读取，内存占用与文件大小无关
+        # 下载失败时抛出 httpx.HTTPError；退出 async with 后连接自动释放回连接池
+        await self.get_access_token()
+        url = await self._build_download_url(file_id)
+        response = await self._request('GET', url, headers=self._stream_headers, stream=True)
+        try:
+            yield response
+        finally:
+            await response.aclose()
+    
+    def _parse_site_url(self) -> Tuple[Optional[str], Optional[str]]:
+        # 从 SharePoint 站点 URL 中解析主机名和站点名称
+        # 示例URL: https://company.sharepoint.com/sites/sitename
         try:
-            # 这里需要根据实际的URL格式来提取site ID
-            # 示例URL: https://company.sharepoint.com/sites/sitename
-            # 实际实现需要根据具体的URL格式来调整
-            parts = self.site_url.split('/')
+            parsed = urlparse(self.site_url)
+            parts = parsed.path.split('/')
             if 'sites' in parts:
                 site_index = parts.index('sites')
-                if site_index + 1 < len(parts):
-                    return parts[site_index + 1]
-            return None
+                if site_index + 1 < len(parts) and parts[site_index + 1]:
+                    return parsed.hostname, parts[site_index + 1]
+            return parsed.hostname, None
         except Exception as e:
-            logger.error(f"Error extracting site ID: {e}")
-            return None
+            logger.error(f"Error parsing site URL: {e}")
+            return None, None
+    
+    async def _resolve_site_id(self) -> str:
+        # 通过 GET /sites/{hostname}:/sites/{sitename} 获取站点的真实ID并缓存
+        # 站点名称并不是 Graph 接受的 site ID，很多租户的 site ID 无法从URL推导
+        # URL无法解析时抛出 ValueError，请求失败时抛出 httpx.HTTPError
+        if self._site_id_cache:
+            return self._site_id_cache
+        
+        async with self._site_id_lock:
+            if self._site_id_cache:
+                return self._site_id_cache
+            
+            if not self._hostname or not self._site_name:
+                raise ValueError(f"Could not extract site ID from URL: {self.site_url}")
+            
+            await self.get_access_token()
+            url = f"{self.base_url}/sites/{self._hostname}:/sites/{self._site_name}?$select=id"
+            response = await self._request('GET', url, headers=self._download_headers)
+            self._site_id_cache = response.json()['id']
+            logger.info(f"Resolved site ID: {self._site_id_cache}")
+            return self._site_id_cache
     
     async def test_connection(self) -> bool:
         # 测试与 SharePoint Graph API 的连接
         try:
-            token = await self.get_access_token()
-            return token is not None
-        except Exception as e:
+            await self.get_access_token()
+            return True
+        except (httpx.HTTPError, KeyError, ValueError) as e:
             logger.error(f"Connection test failed: {e}")
             return False
     
@@ -0,0 +1,140 @@
+import asyncio
+import functools
+import logging
+import time
+from typing import Callable, List, Optional, Tuple, Type
+
+import httpx
+
+try:
+    from aiolimiter import AsyncLimiter
+except ImportError:  # aiolimiter 为可选依赖，未安装时不做主动限速
+    AsyncLimiter = None
+
+logger = logging.getLogger(__name__)
+
+# Microsoft Graph 单个应用的请求配额：每10分钟10000次，折合每分钟1000次
+GRAPH_REQUESTS_PER_MINUTE = 1000
+
+# 可以重试的HTTP状态码，其他错误（如401、404）重试也不会成功
+RETRYABLE_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+# 表示服务端限流的状态码，AIMD控制器据此降低并发
+THROTTLE_STATUS_CODES = frozenset({429, 503})
+# 可以重试的网络错误：超时、连接中断和服务端协议错误
+# 其他传输错误（如 UnsupportedProtocol、LocalProtocolError、ProxyError）是配置问题，重试也不会成功
+RETRYABLE_TRANSPORT_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+def is_retryable(error: Exception) -> bool:
+    # 判断错误是否值得重试：限流和服务端5xx错误、超时及网络错误可以重试
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code in RETRYABLE_STATUS_CODES
+    return isinstance(error, RETRYABLE_TRANSPORT_ERRORS)
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    # 解析 Retry-After 响应头（秒数），无法解析时返回 None
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+def create_rate_limiter(requests_per_minute: int = GRAPH_REQUESTS_PER_MINUTE):
+    # 创建主动限速的令牌桶，未安装 aiolimiter 时返回 None
+    if AsyncLimiter is None:
+        return None
+    return AsyncLimiter(max_rate=requests_per_minute, time_period=60)
+
+class AIMDController:
+    # 基于AIMD（加性增、乘性减）的并发控制器
+    # 正常响应时并发上限缓慢增加，遇到限流时减半，用法与 asyncio.Semaphore 相同：async with controller
+
+    def __init__(self, max_limit: int, min_limit: int = 1, initial_limit: Optional[int] = None,
+                 increase_step: float = 0.5, decrease_factor: float = 0.5, cooldown: float = 1.0):
+        # max_limit / min_limit: 并发上限的取值范围
+        # initial_limit: 初始并发上限，默认为 max_limit
+        # cooldown: 两次乘性减之间的最短间隔（秒），避免同一批并发请求的429把上限连续减到最小
+        self.max_limit = max_limit
+        self.min_limit = min_limit
+        self.current_limit = float(initial_limit if initial_limit is not None else max_limit)
+        self.increase_step = increase_step
+        self.decrease_factor = decrease_factor
+        self.cooldown = cooldown
+        self._in_flight = 0
+        self._waiters: List[asyncio.Future] = []
+        self._last_decrease = 0.0
+
+    def on_success(self):
+        # 请求成功：并发上限加性增长
+        previous = int(self.current_limit)
+        self.current_limit = min(float(self.max_limit), self.current_limit + self.increase_step)
+        if int(self.current_limit) > previous:
+            self._wake_waiters()
+
+    def on_throttle(self):
+        # 请求被限流：并发上限乘性减少
+        now = time.monotonic()
+        if now - self._last_decrease < self.cooldown:
+            return
+        self._last_decrease = now
+        self.current_limit = max(float(self.min_limit), self.current_limit * self.decrease_factor)
+        logger.warning(f"Request throttled, concurrency limit reduced to {int(self.current_limit)}")
+
+    async def acquire(self):
+        # 当前并发数达到上限时等待，直到有任务释放或上限提高
+        while self._in_flight >= int(self.current_limit):
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            await waiter
+        self._in_flight += 1
+
+    def release(self):
+        self._in_flight -= 1
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        # 唤醒所有等待者，由它们重新检查并发上限
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.release()
+
+def retry_with_backoff(max_retries: int = 3,
+                       retry_on: Tuple[Type[Exception], ...] = (httpx.HTTPStatusError, httpx.TransportError),
+                       classify: Callable[[Exception], bool] = is_retryable):
+    # 为 SharePointGraphAPI 的请求方法添加重试
+    # retry_on: 需要捕获的异常类型；classify: 判断捕获的异常是否可以重试，不可重试的异常直接抛出
+    # 重试前按 Retry-After（缺省为指数退避 2**attempt 秒）等待，
+    # 同时通知实例上的 AIMD 控制器（self.controller）调整并发上限
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(self, *args, **kwargs):
+            attempt = 0
+            while True:
+                try:
+                    result = await func(self, *args, **kwargs)
+                except retry_on as e:
+                    response = e.response if isinstance(e, httpx.HTTPStatusError) else None
+                    if response is not None and response.status_code in THROTTLE_STATUS_CODES:
+                        if self.controller is not None:
+                            self.controller.on_throttle()
+                    if not classify(e) or attempt >= max_retries:
+                        raise
+                    retry_after = parse_retry_after(response.headers.get('Retry-After')) if response is not None else None
+                    delay = retry_after if retry_after is not None else 2 ** attempt
+                    attempt += 1
+                    logger.warning(f"Request failed: {e!r}, retrying in {delay}s (attempt {attempt}/{max_retries})")
+                    await asyncio.sleep(delay)
+                    continue
+                if self.controller is not None:
+                    self.controller.on_success()
+                return result
+        return wrapper
+    return decorator
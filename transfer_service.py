@@ -1,15 +1,20 @@
 import asyncio
 import logging
+import httpx
 from typing import List, Dict, Optional
 from datetime import datetime
 import io
 
 from .graph_api import SharePointGraphAPI
 from .blob_upload import BlobUploadService
+from .throttling import AIMDController
 from ..utils.encryption import decrypt_string
 
 logger = logging.getLogger(__name__)
 
+# 流式传输时每次从SharePoint读取的数据块大小
+STREAM_CHUNK_SIZE = 4 * 1024 * 1024
+
 class FileTransferService:
     # 文件传输服务 协调SharePoint和Azure Blob之间的文件传输
     
@@ -19,6 +24,18 @@ class FileTransferService:
         self.config = config_data
         self.graph_api = None
         self.blob_service = None
+        # 同时传输的最大文件数，默认8（与Azure SDK的默认并行度一致）
+        self.max_concurrency = int(self.config.get('max_concurrency', 8))
+        # 并发控制器：Graph API 返回429/503时自动降低并发，持续成功时逐步恢复
+        self.controller = AIMDController(max_limit=self.max_concurrency)
+        # 是否为服务端不会自动计算MD5的上传（长度未知或分块上传的大文件）写入Content-MD5属性
+        self.compute_md5 = bool(self.config.get('compute_md5', False))
+        # 单个文件分块上传到Blob时的并行度，与 max_concurrency 相乘即为Blob请求的并发上限
+        self.blob_upload_concurrency = int(self.config.get('blob_upload_concurrency', 4))
+        # 上传到Blob时的文件名前缀
+        self.blob_prefix = self.config.get('blob_prefix', 'sharepoint/')
+        # 是否跳过Blob中已存在且SharePoint上未修改的文件
+        self.skip_unchanged = bool(self.config.get('skip_unchanged', True))
         self._validate_config()
         self._initialize_services()
     
@@ -34,6 +51,7 @@ class FileTransferService:
         # 初始化SharePoint Graph API和Azure Blob服务
         try:
             # 解密敏感信息
+            # 解密只在初始化时执行一次，解密结果由各服务实例持有，不要在单个文件的传输路径中调用 decrypt_string
             decrypted_client_secret = decrypt_string(self.config['client_secret'])
             decrypted_connection_string = decrypt_string(self.config['connection_string'])
             
@@ -42,77 +60,163 @@ class FileTransferService:
                 tenant_id=self.config['tenant_id'],
                 client_id=self.config['client_id'],
                 client_secret=decrypted_client_secret,
-                site_url=self.config['sharepoint_site_url']
+                site_url=self.config['sharepoint_site_url'],
+                controller=self.controller
             )
             
             # 初始化Azure Blob服务
-            self.blob_service = BlobUploadService(decrypted_connection_string)
+            self.blob_service = BlobUploadService(
+                decrypted_connection_string,
+                max_concurrency=self.blob_upload_concurrency
+            )
             
             logger.info("File transfer service initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize file transfer service: {e}")
             raise
     
+    async def _transfer_one(self, file_info: Dict, base_metadata: Dict[str, str]) -> bool:
+        # 传输单个文件：从SharePoint下载后上传到Azure Blob
+        # base_metadata: 本批次所有文件共用的元数据（来源、上传时间等）
+        # 同时进行的传输数量由 self.controller 控制
+        async with self.controller:
+            # 上传到Azure Blob
+            blob_name = self.blob_prefix + file_info['name']
+            
+            # 准备元数据，文件大小直接使用SharePoint列表返回的size，无需读取文件内容
+            metadata = {
+                **base_metadata,
+                "original_name": file_info['name'],
+                "sharepoint_item_id": file_info['id'],
+                "file_size": str(file_info.get('size', 0)),
+                "sharepoint_modified_time": file_info.get('last_modified') or ''
+            }
+            
+            # 以流式方式下载文件，边下载边上传，内存中只保留当前数据块
+            # 下载失败（可重试的错误已在 graph_api 中重试过）时抛出 httpx.HTTPError，由调用方记录为失败文件
+            async with self.graph_api.download_file_stream(file_info['id']) as response:
+                chunks = response.aiter_bytes(STREAM_CHUNK_SIZE)
+                # aiter_bytes 返回解压后的数据，响应被压缩时 Content-Length 与实际长度不符，按未知长度处理
+                encoded = response.headers.get('Content-Encoding', 'identity').lower() != 'identity'
+                content_length = None if encoded else response.headers.get('Content-Length')
+                
+                # 同时保存源文件和元数据到同一个Blob
+                success = await self.blob_service.upload_with_metadata(
+                    container_name=self.config['blob_container'],
+                    blob_name=blob_name,
+                    file_data=chunks,
+                    metadata=metadata,
+                    length=int(content_length) if content_length else None,
+                    compute_md5=self.compute_md5
+                )
+            
+            if success:
+                logger.info(f"File transferred successfully: {file_info['name']}")
+            else:
+                logger.error(f"File upload failed: {file_info['name']}")
+            return success
+    
+    def _is_unchanged(self, file_info: Dict, existing: Dict[str, Dict[str, str]]) -> bool:
+        # 判断文件是否已上传且此后在SharePoint上没有修改
+        # existing: Blob名称到元数据的映射
+        metadata = existing.get(self.blob_prefix + file_info['name'])
+        if metadata is None:
+            return False
+        # Blob名称不包含文件夹路径，不同文件夹中的同名文件会对应同一个Blob
+        # 必须是同一个SharePoint文件且大小一致才跳过，否则照常覆盖
+        if metadata.get('sharepoint_item_id') != file_info['id']:
+            return False
+        if metadata.get('file_size') != str(file_info.get('size', 0)):
+            return False
+        uploaded_modified_time = metadata.get('sharepoint_modified_time')
+        modified_time = file_info.get('last_modified')
+        # Graph 返回的时间都是相同格式的ISO 8601 UTC字符串，可以直接按字符串比较
+        return bool(uploaded_modified_time and modified_time and modified_time <= uploaded_modified_time)
+    
     async def transfer_files(self, folder_path: str = "/") -> Dict:
         # 执行文件传输
         try:
             logger.info(f"Starting file transfer, path: {folder_path}")
             
-            # 获取文件列表
-            files = await self.graph_api.list_files(folder_path)
-            
-            if not files:
-                return {"success": True, "message": "No files found for transfer", "transferred_count": 0}
+            # 同一批次的文件共用上传时间和固定的元数据字段
+            base_metadata = {
+                "source": "sharepoint",
+                "transfer_service": "FileTransferService",
+                "upload_time": datetime.now().isoformat()
+            }
             
-            # 执行传输
+            # 列举和传输通过有界队列衔接：列举到第一页文件就开始传输，不必等待全部分页返回
+            # 队列长度有限，列举速度超过传输速度时会自动等待
+            worker_count = self.max_concurrency
+            queue: asyncio.Queue = asyncio.Queue(maxsize=worker_count * 2)
+            found_count = 0
+            skipped_count = 0
             transferred_count = 0
             failed_files = []
             
-            for file_info in files:
+            # 一次性列出已上传的Blob及其元数据，用于跳过未修改的文件
+            existing = {}
+            if self.skip_unchanged:
+                existing = await self.blob_service.list_blob_metadata(
+                    self.config['blob_container'], name_starts_with=self.blob_prefix
+                )
+            
+            async def produce():
+                # 按页获取文件列表并放入队列，结束时为每个传输协程放入一个结束标记
+                nonlocal found_count, skipped_count
                 try:
-                    # 下载文件
-                    file_data = await self.graph_api.download_file(file_info['id'])
-                    if not file_data:
-                        logger.error(f"Failed to download file: {file_info['name']}")
-                        failed_files.append(file_info['name'])
-                        continue
-                    
-                    # 上传到Azure Blob
-                    blob_name = f"sharepoint/{file_info['name']}"
-                    
-                    # 准备元数据
-                    metadata = {
-                        "source": "sharepoint",
-                        "original_name": file_info['name'],
-                        "upload_time": datetime.now().isoformat(),
-                        "file_size": str(len(file_data)),
-                        "transfer_service": "FileTransferService",
-                        "sharepoint_modified_time": file_info.get('lastModifiedDateTime', '')
-                    }
-                    
-                    # 同时保存源文件和元数据到同一个Blob
-                    success = await self.blob_service.upload_with_metadata(
-                        container_name=self.config['blob_container'],
-                        blob_name=blob_name,
-                        file_data=file_data,
-                        metadata=metadata
-                    )
-                    
+                    async for page in self.graph_api.iter_files(folder_path):
+                        for file_info in page:
+                            found_count += 1
+                            if self._is_unchanged(file_info, existing):
+                                skipped_count += 1
+                                continue
+                            await queue.put(file_info)
+                finally:
+                    for _ in range(worker_count):
+                        await queue.put(None)
+            
+            async def work():
+                # 从队列中取出文件并传输，直到遇到结束标记
+                nonlocal transferred_count
+                while (file_info := await queue.get()) is not None:
+                    try:
+                        success = await self._transfer_one(file_info, base_metadata)
+                    except httpx.HTTPStatusError as e:
+                        success = False
+                        logger.error(f"File download failed {file_info['name']}: HTTP {e.response.status_code}")
+                    except Exception as e:
+                        success = False
+                        logger.error(f"File transfer failed {file_info['name']}: {e}")
                     if success:
                         transferred_count += 1
-                        logger.info(f"File transferred successfully: {file_info['name']}")
                     else:
                         failed_files.append(file_info['name'])
-                        logger.error(f"File upload failed: {file_info['name']}")
-                    
-                except Exception as e:
-                    failed_files.append(file_info['name'])
-                    logger.error(f"File transfer failed {file_info['name']}: {e}")
+            
+            outcomes = await asyncio.gather(
+                produce(), *(work() for _ in range(worker_count)), return_exceptions=True
+            )
+            # 列举失败时整个传输失败，但已传输的文件照实统计
+            listing_error = outcomes[0]
+            if isinstance(listing_error, BaseException):
+                logger.error(f"Error occurred while listing files: {listing_error}")
+                return {
+                    "success": False,
+                    "message": f"Transfer failed while listing files: {listing_error}, success: {transferred_count}, failed: {len(failed_files)}, skipped: {skipped_count}",
+                    "transferred_count": transferred_count,
+                    "skipped_count": skipped_count,
+                    "failed_files": failed_files,
+                    "timestamp": datetime.now().isoformat()
+                }
+            
+            if found_count == 0:
+                return {"success": True, "message": "No files found for transfer", "transferred_count": 0}
             
             result = {
                 "success": True,
-                "message": f"Transfer completed, success: {transferred_count}, failed: {len(failed_files)}",
+                "message": f"Transfer completed, success: {transferred_count}, failed: {len(failed_files)}, skipped: {skipped_count}",
                 "transferred_count": transferred_count,
+                "skipped_count": skipped_count,
                 "failed_files": failed_files,
                 "timestamp": datetime.now().isoformat()
             }
@@ -130,10 +234,25 @@ class FileTransferService:
                 "timestamp": datetime.now().isoformat()
             }
     
+    async def close(self):
+        # 释放SharePoint Graph API和Azure Blob服务持有的HTTP连接
+        if self.graph_api is not None:
+            await self.graph_api.close()
+        if self.blob_service is not None:
+            await self.blob_service.aclose()
+    
+    async def __aenter__(self):
+        return self
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+    
     async def list_blob_files(self) -> List[str]:
-        # 列出Azure Blob中的文件
+        # 列出Azure Blob中由本服务上传的文件（以 blob_prefix 开头）
         try:
-            return await self.blob_service.list_blob_files(self.config['blob_container'])
+            return await self.blob_service.list_blob_files(
+                self.config['blob_container'], name_starts_with=self.blob_prefix
+            )
         except Exception as e:
             logger.error(f"Failed to get Blob file list: {e}")
             return []
@@ -144,8 +263,8 @@ class FileTransferService:
             # 测试SharePoint连接
             sharepoint_status = await self.graph_api.test_connection()
             
-            # 测试Azure Blob连接（使用异步线程池）
-            blob_status = await asyncio.to_thread(self.blob_service.test_connection)
+            # 测试Azure Blob连接
+            blob_status = await self.blob_service.test_connection()
             
             return {
                 "sharepoint": sharepoint_status,